@@ -1,28 +1,52 @@
 #!/usr/bin/env python
-# pylint: disable=logging-fstring-interpolation, C0116, W0613, W0719, R0912, R0915
+# pylint: disable=C0116, C0302, W0613, W0719, R0912, R0915
 # Standard Library Imports
+import asyncio
+import atexit
+import contextlib
+import functools
 import os
 import logging
-import traceback
 import re
 import shutil
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
+from weakref import WeakValueDictionary
 
 # Third-Party Imports
-from telegram import Update, InputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update, CallbackQuery, Document, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
     filters,
 )
 from telegram.constants import ParseMode
-from telegram.error import TelegramError, NetworkError
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from telegram.error import BadRequest, TelegramError, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception
+
+# Optional: libuv-based event loop (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Optional: faster JSON decoding of Bot API responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Suppress warnings
 import warnings
@@ -33,36 +57,229 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set.")
 
-DOWNLOADS_DIR = os.getenv("DOWNLOADS_DIR", "downloads")
-MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE_MB", 200)) * 1024 * 1024
+MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", 200))
+MAX_FILE_SIZE = MAX_FILE_SIZE_MB * 1024 * 1024
+FILE_TOO_LARGE_TEXT = f"⚠️ File too large. Max size: {MAX_FILE_SIZE_MB}MB"
+TIMEOUT_TEXT = "⏳ Session expired. Use /start to begin again."
+DOWNLOAD_FAILED_TEXT = "⚠️ File download failed. Please send the PDF again."
+EVICTED_TEXT = "⏳ This upload was closed to make room for others. Please send the PDF again."
 MIN_DISK_SPACE = 2 * MAX_FILE_SIZE  # Require 2x file size as buffer
+IN_MEMORY_MAX_SIZE = int(os.getenv("IN_MEMORY_MAX_SIZE_MB", 25)) * 1024 * 1024  # Smaller PDFs never touch disk
+IN_MEMORY_BUDGET = int(os.getenv("IN_MEMORY_BUDGET_MB", 256)) * 1024 * 1024  # All in-memory PDFs together
+SHM_DIR = "/dev/shm"
+
+def default_downloads_dir() -> str:
+    """Prefer RAM-backed /dev/shm when it can hold MIN_DISK_SPACE."""
+    try:
+        stat = os.statvfs(SHM_DIR)
+        if stat.f_bavail * stat.f_frsize >= MIN_DISK_SPACE:
+            return os.path.join(SHM_DIR, "pdf_bot")
+    except (OSError, AttributeError):
+        pass
+    return "downloads"
+
+DOWNLOADS_DIR = os.getenv("DOWNLOADS_DIR") or default_downloads_dir()
+os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+DOWNLOADS_PREFIX = os.path.join(DOWNLOADS_DIR, "")
+DOWNLOADS_DIR_FD: Optional[int] = None  # Opened once in main(); unlinks resolve relative to it
 TIMESTAMP_FORMAT = os.getenv("TIMESTAMP_FORMAT", "%Y%m%d_%H%M%S")
+TIMESTAMP_FORMATS = {  # Timestamp menu choice -> strftime format
+    'ymdhms': "%Y%m%d_%H%M%S",
+    'ymd': "%Y%m%d",
+    'dmy': "%d%m%Y",
+}
+# Webhook mode is used when WEBHOOK_URL (the bot's public base URL) is set; otherwise long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+if WEBHOOK_URL and not WEBHOOK_URL.startswith("https://"):
+    WEBHOOK_URL = f"https://{WEBHOOK_URL}"
+WEBHOOK_PATH = "webhook"
+WEBHOOK_ENDPOINT = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}" if WEBHOOK_URL else None
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", 8443))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 1000))  # Open uploads kept before the oldest is evicted
+FILE_CACHE_MAX = 128
+SESSION_KEYS = ('pdf_state', 'pdf_bytes', 'need_cleanup', 'session_ended')  # Per-upload keys in context.user_data
+STATUS_EDIT_DELAY = 0.15  # Seconds; bursts of status edits collapse into one
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # 1 MiB write buffer for downloaded PDFs
+STALE_FILE_AGE = 3600  # Seconds before an untouched download is reaped
+REAP_INTERVAL = 300  # Seconds between sweeps of DOWNLOADS_DIR
+
+# Recently downloaded PDFs, keyed by "<user_id>:<file_unique_id>"
+FILE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+# Users with an open upload, least recently active first; bounds user_data and held PDFs
+ACTIVE_UPLOADS: "OrderedDict[int, None]" = OrderedDict()
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv("LOG_LEVEL", "WARNING").upper()
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Characters not allowed in filenames or user-provided text
+INVALID_CHARS_RE = re.compile(r'[<>:"/\\|?*\x00-\x1F]')
+
+# Inside MarkdownV2 code spans only backslash and backtick need escaping
+MDV2_CODE_ESCAPE = str.maketrans({'\\': '\\\\', '`': '\\`'})
+
 # Conversation states
 (SELECTING_ACTION, AWAITING_PREFIX, AWAITING_SUFFIX, AWAITING_REMOVE,
  AWAITING_REPLACE_OLD, AWAITING_REPLACE_NEW, AWAITING_CASE, AWAITING_TIMESTAMP) = range(8)
 FALLBACK = ConversationHandler.END
 
+# Only messages (PDFs, text, commands) and button taps are handled; Telegram drops the rest
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Menu keyboards, identical for every user
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Add Prefix", callback_data="add_prefix"),
+     InlineKeyboardButton("Add Suffix", callback_data="add_suffix")],
+    [InlineKeyboardButton("Remove Text", callback_data="remove_name"),
+     InlineKeyboardButton("Replace Text", callback_data="replace_word")],
+    [InlineKeyboardButton("Change Case", callback_data="change_case"),
+     InlineKeyboardButton("Add Timestamp", callback_data="add_timestamp")],
+    [InlineKeyboardButton("Apply", callback_data="apply"),
+     InlineKeyboardButton("Reset", callback_data="reset"),
+     InlineKeyboardButton("Cancel", callback_data="cancel")]
+])
+CASE_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Uppercase", callback_data="case_upper"),
+     InlineKeyboardButton("Lowercase", callback_data="case_lower"),
+     InlineKeyboardButton("Title Case", callback_data="case_title")],
+    [InlineKeyboardButton("Back", callback_data="back_to_menu")]
+])
+TIMESTAMP_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("YYYYMMDD_HHMMSS", callback_data="ts_ymdhms"),
+     InlineKeyboardButton("YYYYMMDD", callback_data="ts_ymd"),
+     InlineKeyboardButton("DDMMYYYY", callback_data="ts_dmy")],
+    [InlineKeyboardButton("Back", callback_data="back_to_menu")]
+])
+
+# Callback data accepted in each state; handlers match by set membership instead of regex
+MAIN_MENU_ACTIONS = frozenset({
+    'add_prefix', 'add_suffix', 'remove_name', 'replace_word', 'change_case',
+    'add_timestamp', 'apply', 'reset', 'cancel'
+})
+CASE_CHOICES = frozenset({'case_upper', 'case_lower', 'case_title'})
+TIMESTAMP_CHOICES = frozenset(f"ts_{key}" for key in TIMESTAMP_FORMATS)
+# Submenus also carry a Back button, handled by the same callback as their choices
+CASE_MENU_CALLBACKS = CASE_CHOICES | {'back_to_menu'}
+TIMESTAMP_MENU_CALLBACKS = TIMESTAMP_CHOICES | {'back_to_menu'}
+
+# Files waiting to be unlinked, as (file_path, user_id)
+CLEANUP_QUEUE: "asyncio.Queue[tuple]" = asyncio.Queue()
+CLEANUP_BATCH_MAX = 64
+# Unlinks and reaper sweeps get their own threads instead of sharing the default executor
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cleanup")
+
+# Recent (user, message, button) taps, used to drop double taps
+CALLBACK_DEDUP_WINDOW = 0.5  # Seconds
+CALLBACK_DEDUP_MAX = 10000
+RECENT_CALLBACKS: "OrderedDict[tuple, float]" = OrderedDict()
+
+# Per-user locks, keyed like user_data: one user's updates run in order, even across chats,
+# everyone else runs concurrently. Locks vanish once no handler references them.
+SESSION_LOCKS: "WeakValueDictionary[int, asyncio.Lock]" = WeakValueDictionary()
+
+# --- Bot API Transport ---
+class FastJSONRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson when available."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        if orjson:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass  # Let the stdlib path log it and raise TelegramError
+        return HTTPXRequest.parse_json_payload(payload)
+
+def build_requests() -> "tuple[FastJSONRequest, FastJSONRequest]":
+    """Request objects for Bot API calls and for getUpdates; all transport settings live here."""
+    api_request = FastJSONRequest(
+        connection_pool_size=256,
+        read_timeout=20,
+        write_timeout=60,  # Large PDF uploads
+        pool_timeout=5,
+        http_version="2"  # Concurrent sends multiplex over a few TLS connections
+    )
+    # One long poll at a time: neither a larger pool nor HTTP/2 would be used
+    get_updates_request = FastJSONRequest()
+    return api_request, get_updates_request
+
+class MemoryBudget:
+    """Bytes of PDF data held in user_data; uploads that would exceed the limit go to disk."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size: int) -> bool:
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used = max(0, self.used - size)
+
+PDF_MEMORY = MemoryBudget(IN_MEMORY_BUDGET)
+
+class BytesSink:
+    """Target for File.download_to_memory that keeps the downloaded bytes object itself."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        return self.chunks[0] if len(self.chunks) == 1 else b''.join(self.chunks)
+
+# --- Session State ---
+@dataclass(slots=True)
+class PdfState:
+    """Rename options for the PDF a user is working on."""
+    original_name: str
+    file_id: str
+    file_path: Optional[str] = None
+    message_id: Optional[int] = None
+    prefix: str = ''
+    suffix: str = ''
+    remove: str = ''
+    replace_old: str = ''
+    replace_new: str = ''
+    case: Optional[str] = None
+    timestamp_format: Optional[str] = None
+    timestamp: str = ''
+
+    def reset(self) -> None:
+        """Clear every rename option, keeping the file."""
+        self.prefix = self.suffix = self.remove = ''
+        self.replace_old = self.replace_new = ''
+        self.case = self.timestamp_format = None
+        self.timestamp = ''
+
 # --- Enhanced Helper Functions ---
 def validate_input(text: str) -> bool:
     """Strict validation for user-provided text."""
     if not text or len(text) > 100 or len(text.strip()) == 0:
         return False
-    return not bool(re.search(r'[<>:"/\\|?*\x00-\x1F]', text))
+    return not INVALID_CHARS_RE.search(text)
+
+def escape_code(text: str) -> str:
+    """Escape text for use inside a MarkdownV2 `code` span."""
+    return text.translate(MDV2_CODE_ESCAPE)
 
 def sanitize_filename(filename: str) -> str:
     """Nuclear-grade filename sanitization."""
     if not filename:
         return "unnamed.pdf"
-    filename = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', filename)
+    filename = INVALID_CHARS_RE.sub('', filename)
     filename = filename.replace('..', '').strip(' .')
     return filename[:255] or "unnamed.pdf"  # Limit to 255 chars
 
@@ -73,53 +290,279 @@ def ensure_disk_space(required: int) -> bool:
         available_space = stat.f_bavail * stat.f_frsize
         return available_space >= required
     except (OSError, AttributeError) as e:
-        logger.error(f"Failed to check disk space: {e}")
+        logger.error("Failed to check disk space: %s", e)
         return False
 
-async def safe_cleanup(file_path: Optional[str], user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """Guaranteed cleanup with retries."""
-    if file_path and os.path.exists(file_path):
+@functools.lru_cache(maxsize=256)
+def format_timestamp(fmt: str, epoch_sec: int) -> str:
+    """strftime for a whole second; users in the same second share the result."""
+    return datetime.fromtimestamp(epoch_sec).strftime(fmt)
+
+def is_duplicate_callback(query: CallbackQuery) -> bool:
+    """True if the user tapped the same button within CALLBACK_DEDUP_WINDOW."""
+    now = time.monotonic()
+    # Keys are only ever inserted, so the oldest taps sit at the front
+    while RECENT_CALLBACKS:
+        oldest = next(iter(RECENT_CALLBACKS.values()))
+        if now - oldest < CALLBACK_DEDUP_WINDOW:
+            break
+        RECENT_CALLBACKS.popitem(last=False)
+    message_id = query.message.message_id if query.message else None
+    key = (query.from_user.id, message_id, query.data)
+    if key in RECENT_CALLBACKS:
+        return True
+    RECENT_CALLBACKS[key] = now
+    if len(RECENT_CALLBACKS) > CALLBACK_DEDUP_MAX:
+        RECENT_CALLBACKS.popitem(last=False)
+    return False
+
+def write_file(file_path: str, data: bytes) -> None:
+    """Write downloaded bytes to disk through a large buffer."""
+    with open(file_path, 'wb', buffering=DOWNLOAD_BUFFER_SIZE) as file:
+        file.write(data)
+
+def touch_file(file_path: str) -> bool:
+    """Refresh file_path's mtime so the reaper keeps it; False if it is gone."""
+    try:
+        os.utime(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def remove_stale_files(root: str, max_age: float, keep: "frozenset[str]" = frozenset()) -> int:
+    """Delete files under root not modified for max_age seconds, except those in keep; returns the count."""
+    cutoff = time.time() - max_age
+    removed = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if path in keep:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+def session_file_paths(application: Application) -> "set[str]":
+    """Downloads that open sessions still point at."""
+    paths = set()
+    for user_data in application.user_data.values():
+        pdf_state = user_data.get('pdf_state')
+        if pdf_state and pdf_state.file_path:
+            paths.add(pdf_state.file_path)
+    return paths
+
+async def reap_stale_downloads(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job: bound DOWNLOADS_DIR growth from files no session cleaned up."""
+    # Files still reachable from a session or the cache stay, however old they are
+    keep = frozenset(session_file_paths(context.application) | set(FILE_CACHE.values()))
+    loop = asyncio.get_running_loop()
+    removed = await loop.run_in_executor(CLEANUP_EXECUTOR, remove_stale_files, DOWNLOADS_DIR, STALE_FILE_AGE, keep)
+    if removed:
+        logger.info("Reaped %d stale download(s) from %s", removed, DOWNLOADS_DIR)
+
+def open_downloads_dir() -> Optional[int]:
+    """Open DOWNLOADS_DIR for dir_fd-relative unlinks, where the platform supports them."""
+    if os.unlink not in os.supports_dir_fd or not hasattr(os, "O_DIRECTORY"):
+        return None
+    return os.open(DOWNLOADS_DIR, os.O_RDONLY | os.O_DIRECTORY)
+
+def unlink_batch(batch: list) -> None:
+    """Delete a batch of (file_path, user_id) entries, retrying each up to 3 times."""
+    dir_fd = DOWNLOADS_DIR_FD
+    for file_path, user_id in batch:
+        if dir_fd is not None and file_path.startswith(DOWNLOADS_PREFIX):
+            target, fd = file_path[len(DOWNLOADS_PREFIX):], dir_fd
+        else:
+            target, fd = file_path, None
         for attempt in range(3):
             try:
-                os.remove(file_path)
-                logger.info(f"Cleaned up file for {user_id}: {file_path}")
+                os.unlink(target, dir_fd=fd)
+                logger.info("Cleaned up file for %s: %s", user_id, file_path)
+                break
+            except FileNotFoundError:
                 break
             except (OSError, PermissionError) as e:
                 if attempt == 2:
-                    logger.error(f"FINAL FAILURE deleting {file_path}: {e}")
-    context.user_data.clear()
+                    logger.error("FINAL FAILURE deleting %s: %s", file_path, e)
+
+async def cleanup_worker() -> None:
+    """Drain CLEANUP_QUEUE, unlinking whatever has queued up in one thread hop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await CLEANUP_QUEUE.get()]
+        while len(batch) < CLEANUP_BATCH_MAX:
+            try:
+                batch.append(CLEANUP_QUEUE.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        await loop.run_in_executor(CLEANUP_EXECUTOR, unlink_batch, batch)
+
+def drop_pdf_bytes(user_data: dict) -> None:
+    """Forget an in-memory PDF and return its bytes to PDF_MEMORY."""
+    pdf_bytes = user_data.pop('pdf_bytes', None)
+    if pdf_bytes is not None:
+        PDF_MEMORY.release(len(pdf_bytes))
+
+async def safe_cleanup(file_path: Optional[str], user_id: Optional[int], context: ContextTypes.DEFAULT_TYPE):
+    """End the session now; the file is unlinked by the cleanup worker."""
+    if file_path:
+        CLEANUP_QUEUE.put_nowait((file_path, user_id))
+    invalidate_status_message(context)
+    drop_pdf_bytes(context.user_data)
+    if user_id is not None:
+        ACTIVE_UPLOADS.pop(user_id, None)
+    for key in SESSION_KEYS:
+        context.user_data.pop(key, None)
+    if user_id is not None and not context.user_data:
+        context.application.drop_user_data(user_id)
+
+def mark_upload_active(user_id: int) -> None:
+    """Record activity on user_id's upload, making it the last to be evicted."""
+    if user_id in ACTIVE_UPLOADS:
+        ACTIVE_UPLOADS.move_to_end(user_id)
+
+async def evict_idle_uploads(application: Application) -> None:
+    """Close the least recently active uploads beyond MAX_SESSIONS, skipping any in use."""
+    excess = len(ACTIVE_UPLOADS) - MAX_SESSIONS
+    for user_id in list(ACTIVE_UPLOADS)[:max(excess, 0)]:
+        lock = SESSION_LOCKS.get(user_id)
+        user_data = application.user_data[user_id]
+        download = user_data.get('download_task')
+        if (lock is not None and lock.locked()) or (download and not download.done()):
+            continue  # A handler or download is using this session right now
+        async with session_lock(user_id):
+            ACTIVE_UPLOADS.pop(user_id, None)
+            pdf_state = user_data.get('pdf_state')
+            if pdf_state and pdf_state.file_path:
+                CLEANUP_QUEUE.put_nowait((pdf_state.file_path, user_id))
+            drop_pdf_bytes(user_data)
+            user_data.pop('status_render_hash', None)
+            task = user_data.pop('status_edit_task', None)
+            if task:
+                task.cancel()
+            for key in SESSION_KEYS:
+                user_data.pop(key, None)
+            # The conversation is still open; its next update or timeout reads this and ends it
+            user_data['session_ended'] = EVICTED_TEXT
+        logger.info("Evicted idle upload for %s", user_id)
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type((TelegramError, NetworkError))
+TELEGRAM_BACKOFF = wait_exponential_jitter(initial=1, max=30)
+
+def wait_for_telegram(retry_state) -> float:
+    """Honor flood-control retry_after; otherwise back off exponentially with jitter."""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RetryAfter):
+        return float(error.retry_after)
+    return TELEGRAM_BACKOFF(retry_state)
+
+def is_transient_error(error: BaseException) -> bool:
+    """Flood control and network errors; BadRequest subclasses NetworkError but never succeeds."""
+    return isinstance(error, (RetryAfter, NetworkError)) and not isinstance(error, BadRequest)
+
+def is_transient_send_error(error: BaseException) -> bool:
+    """Like is_transient_error, minus TimedOut: the message may have been delivered anyway."""
+    return is_transient_error(error) and not isinstance(error, TimedOut)
+
+telegram_retry = retry(
+    stop=stop_after_attempt(8),
+    wait=wait_for_telegram,
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
 )
-async def send_file_with_retry(chat_id: int, file_path: str, filename: str, context: ContextTypes.DEFAULT_TYPE):
-    """Reliable file sending with retries."""
-    with open(file_path, 'rb') as file:
-        await context.bot.send_document(
-            chat_id=chat_id,
-            document=InputFile(file, filename=filename),
-            caption=f"📄 Renamed: `{filename}`",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
+
+send_retry = retry(
+    stop=stop_after_attempt(8),
+    wait=wait_for_telegram,
+    retry=retry_if_exception(is_transient_send_error),
+    reraise=True
+)
+
+@telegram_retry
+async def tg_call(func, *args, **kwargs):
+    """Await an idempotent Bot API call (edit, delete, get_file, download), retrying transient errors."""
+    return await func(*args, **kwargs)
+
+@send_retry
+async def tg_send(func, *args, **kwargs):
+    """Await a Bot API call that posts a new message; a timed-out send is not repeated."""
+    return await func(*args, **kwargs)
+
+@send_retry
+async def send_file_with_retry(chat_id: int, document: Union[str, bytes], filename: str,
+                               context: ContextTypes.DEFAULT_TYPE):
+    """Reliable file sending with retries; document is a local path, a file_id or the file's bytes."""
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        filename=filename,
+        caption=f"📄 Renamed: `{escape_code(filename)}`",
+        parse_mode=ParseMode.MARKDOWN_V2
+    )
+
+async def wait_for_download(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Wait for a background download started by handle_pdf; its session is not set up yet."""
+    task = context.user_data.get('download_task')
+    if task and task is not asyncio.current_task():
+        await asyncio.wait({task})
+
+async def notify(func, *args, **kwargs) -> None:
+    """Send a Bot API message; a failure is only logged, never raised."""
+    try:
+        await tg_send(func, *args, **kwargs)
+    except TelegramError as e:
+        logger.error("Notification failed: %s", e)
+
+def notify_later(application: Application, func, *args, **kwargs) -> None:
+    """Start notify as an Application task and return without waiting for it."""
+    application.create_task(notify(func, *args, **kwargs))
+
+def edit_or_send_later(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """Replace the tapped menu with text, or send text when the last update was a message."""
+    if update.callback_query and update.callback_query.message:
+        notify_later(context.application, update.callback_query.edit_message_text, text)
+    elif update.effective_chat:
+        notify_later(context.application, context.bot.send_message, chat_id=update.effective_chat.id, text=text)
+
+@contextlib.asynccontextmanager
+async def session_lock(user_id: int):
+    """Hold the lock for one user's session."""
+    lock = SESSION_LOCKS.get(user_id)
+    if lock is None:
+        lock = SESSION_LOCKS[user_id] = asyncio.Lock()
+    async with lock:
+        yield
+
+def serialize_per_session(handler):
+    """Run handler while holding its user's session lock."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not update.effective_user:
+            return await handler(update, context)
+        async with session_lock(update.effective_user.id):
+            await wait_for_download(context)
+            mark_upload_active(update.effective_user.id)
+            return await handler(update, context)
+    return wrapper
 
 # --- Critical Fix: Atomic File Operations ---
 async def atomic_rename(src: str, dst: str) -> bool:
     """Guaranteed atomic rename with fallback."""
     try:
         temp_dst = f"{dst}.tmp"
-        shutil.copy2(src, temp_dst)  # Copy preserves metadata
-        os.replace(temp_dst, dst)    # Atomic operation
+        await asyncio.to_thread(shutil.copy2, src, temp_dst)  # Copy preserves metadata
+        await asyncio.to_thread(os.replace, temp_dst, dst)    # Atomic operation
         return True
-    except (OSError, shutil.Error) as e:
-        logger.error(f"Atomic rename failed: {e}")
+    except (OSError, shutil.Error):
+        logger.exception("Atomic rename failed: %s -> %s", src, dst)
         for f in [temp_dst, dst]:
-            if os.path.exists(f):
-                try:
-                    os.remove(f)
-                except OSError:
-                    pass
+            try:
+                await asyncio.to_thread(os.remove, f)
+            except OSError:
+                pass
         return False
 
 # --- Enhanced PDF Handler ---
@@ -127,67 +570,116 @@ async def handle_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Bulletproof PDF handling."""
     if not update.effective_user or not update.message or not update.message.document:
         if update.message:
-            await update.message.reply_text("⚠️ Invalid file. Please send a PDF.")
+            await tg_send(update.message.reply_text, "⚠️ Invalid file. Please send a PDF.")
         return FALLBACK
 
     user = update.effective_user
     document = update.message.document
+    reply = update.message.reply_text
+    context.user_data.pop('session_ended', None)  # A new upload starts a new conversation
     if document.mime_type != "application/pdf":
-        await update.message.reply_text("❌ Only PDF files are accepted.")
+        await tg_send(reply, "❌ Only PDF files are accepted.")
         return FALLBACK
 
     if document.file_size > MAX_FILE_SIZE:
-        await update.message.reply_text(
-            f"⚠️ File too large. Max size: {MAX_FILE_SIZE//1024//1024}MB"
-        )
+        await tg_send(reply, FILE_TOO_LARGE_TEXT)
         return FALLBACK
 
-    if not ensure_disk_space(MIN_DISK_SPACE):
-        await update.message.reply_text("🚫 Server storage full. Try later.")
+    if not await asyncio.to_thread(ensure_disk_space, MIN_DISK_SPACE):
+        await tg_send(reply, "🚫 Server storage full. Try later.")
         return FALLBACK
 
     # Secure download
     user_dir = os.path.join(DOWNLOADS_DIR, str(user.id))
     try:
-        os.makedirs(user_dir, exist_ok=True)
+        await asyncio.to_thread(os.makedirs, user_dir, exist_ok=True)
     except (OSError, PermissionError) as e:
-        logger.error(f"Failed to create user directory {user_dir}: {e}")
-        await update.message.reply_text("🚫 Server error creating directory. Try later.")
+        logger.error("Failed to create user directory %s: %s", user_dir, e)
+        await tg_send(reply, "🚫 Server error creating directory. Try later.")
         return FALLBACK
-    
-    original_name = sanitize_filename(document.file_name or "document.pdf")
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-    safe_name = f"{os.path.splitext(original_name)[0]}_{timestamp}.pdf"
-    file_path = os.path.join(user_dir, safe_name)
 
-    try:
-        pdf_file = await context.bot.get_file(document.file_id)
-        await pdf_file.download_to_drive(file_path)
-    except Exception as e:
-        logger.error(f"Download failed for {user.id}: {e}")
-        await update.message.reply_text("⚠️ File download failed. Please retry.")
-        await safe_cleanup(file_path, user.id, context)
-        return FALLBACK
+    # The user-supplied name is only kept for display; on disk every upload gets a unique name
+    original_name = sanitize_filename(document.file_name or "document.pdf")
+    file_path = os.path.join(user_dir, f"{uuid.uuid4().hex}.pdf")
 
-    # Initialize state
-    context.user_data.update({
-        'pdf_data': {
-            'original_name': original_name,
-            'file_path': file_path,
-            'prefix': '',
-            'suffix': '',
-            'remove': '',
-            'replace': {'old': '', 'new': ''},
-            'case': None,
-            'timestamp_format': None,
-            'timestamp': ''
-        },
-        'message_id': update.message.message_id
-    })
+    # Skip the download when the same PDF is resent
+    cache_key = f"{user.id}:{document.file_unique_id}"
+    cached_path = FILE_CACHE.get(cache_key)
+    if cached_path and await asyncio.to_thread(touch_file, cached_path):
+        FILE_CACHE.move_to_end(cache_key)
+        logger.info("Reusing cached download for %s: %s", user.id, cached_path)
+        await start_session(update, context, original_name, cached_path)
+        await update_status_message(update, context)
+        return SELECTING_ACTION
 
-    await update_status_message(update, context)
+    # Download in the background so this update does not hold a worker for the whole transfer.
+    # Later updates from this user wait for the task (see wait_for_download) before they run.
+    status_message = await tg_send(reply, "📥 Downloading...")
+    context.user_data['download_task'] = context.application.create_task(
+        finish_download(update, context, status_message, document, file_path, original_name),
+        update=update
+    )
     return SELECTING_ACTION
 
+async def finish_download(update: Update, context: ContextTypes.DEFAULT_TYPE, status_message: Message,
+                          document: Document, file_path: str, original_name: str) -> None:
+    """Download the PDF, then turn the placeholder message into the status menu."""
+    user_id = update.effective_user.id
+    try:
+        try:
+            pdf_file = await tg_call(context.bot.get_file, document.file_id)
+            # The sink keeps the response's immutable bytes, so nothing is copied before the send
+            sink = BytesSink()
+            await tg_call(pdf_file.download_to_memory, sink)
+            data = sink.getvalue()
+            if len(data) < IN_MEMORY_MAX_SIZE and PDF_MEMORY.reserve(len(data)):
+                pdf_bytes = data
+            else:
+                pdf_bytes = None
+                await asyncio.to_thread(write_file, file_path, data)
+        except Exception:
+            logger.exception("Download failed for %s", user_id)
+            await tg_call(status_message.edit_text, "⚠️ File download failed. Please retry.")
+            await safe_cleanup(file_path, user_id, context)
+            # handle_pdf already moved the conversation on; the next update in it ends it
+            context.user_data['session_ended'] = DOWNLOAD_FAILED_TEXT
+            return
+        if pdf_bytes is not None:
+            await start_session(update, context, original_name, None, pdf_bytes)
+        else:
+            cache_key = f"{user_id}:{document.file_unique_id}"
+            FILE_CACHE[cache_key] = file_path
+            if len(FILE_CACHE) > FILE_CACHE_MAX:
+                FILE_CACHE.popitem(last=False)
+            await start_session(update, context, original_name, file_path)
+        await update_status_message(update, context, status_message)
+    finally:
+        if context.user_data.get('download_task') is asyncio.current_task():
+            del context.user_data['download_task']
+
+async def start_session(update: Update, context: ContextTypes.DEFAULT_TYPE, original_name: str,
+                        file_path: Optional[str], pdf_bytes: Optional[bytes] = None) -> None:
+    """Initialize rename state for a freshly received PDF kept on disk or in memory."""
+    user_id = update.effective_user.id
+    # A PDF sent mid-conversation replaces the previous one, whose file is no longer needed
+    previous = get_pdf_state(context)
+    if previous and previous.file_path and previous.file_path != file_path:
+        CLEANUP_QUEUE.put_nowait((previous.file_path, user_id))
+    invalidate_status_message(context)
+    context.user_data['pdf_state'] = PdfState(
+        original_name=original_name,
+        file_id=update.message.document.file_id,
+        file_path=file_path,
+        message_id=update.message.message_id
+    )
+    drop_pdf_bytes(context.user_data)
+    if pdf_bytes is not None:
+        context.user_data['pdf_bytes'] = pdf_bytes
+    context.user_data['need_cleanup'] = True
+    ACTIVE_UPLOADS[user_id] = None
+    ACTIVE_UPLOADS.move_to_end(user_id)
+    await evict_idle_uploads(context.application)
+
 # --- Robust Apply Changes ---
 async def apply_changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Failure-resistant rename and send."""
@@ -195,44 +687,58 @@ async def apply_changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     if not query or not update.effective_chat:
         return FALLBACK
     await query.answer("⏳ Processing...")
+    edit = query.edit_message_text
     user_id = update.effective_user.id
-    pdf_data = get_pdf_data(context)
+    pdf_state = get_pdf_state(context)
 
-    if not pdf_data:
-        await query.edit_message_text("❌ Session expired. Upload again.")
+    if not pdf_state:
+        await tg_call(edit, "❌ Session expired. Upload again.")
         return FALLBACK
 
-    original_path = pdf_data.get('file_path')
-    if not original_path or not os.path.exists(original_path):
-        await query.edit_message_text("⚠️ File missing. Please re-upload.")
-        await safe_cleanup(None, user_id, context)
-        return FALLBACK
-
-    final_name = generate_preview_filename(pdf_data)
+    final_name = generate_preview_filename(pdf_state)
     if not final_name or "Error" in final_name:
-        await query.edit_message_text("⚠️ Invalid filename generated. Reset and retry.")
+        await tg_call(edit, "⚠️ Invalid filename generated. Reset and retry.")
         return SELECTING_ACTION
 
-    user_dir = os.path.dirname(original_path)
-    new_path = os.path.join(user_dir, final_name)
+    pdf_bytes = context.user_data.get('pdf_bytes')
+    original_path = pdf_state.file_path
+    unchanged = final_name == pdf_state.original_name
+    if not unchanged and pdf_bytes is None and (
+            not original_path or not await asyncio.to_thread(os.path.exists, original_path)):
+        await tg_call(edit, "⚠️ File missing. Please re-upload.")
+        await safe_cleanup(None, user_id, context)
+        return FALLBACK
+
+    if unchanged:
+        # Nothing to rename: Telegram resends the original upload, no upload from here
+        new_path = None
+        document = pdf_state.file_id
+    elif pdf_bytes is not None:
+        # Small PDFs are sent straight from memory under the new name
+        new_path = None
+        document = pdf_bytes
+    else:
+        user_dir = os.path.dirname(original_path)
+        new_path = os.path.join(user_dir, final_name)
 
-    # Atomic rename
-    if not await atomic_rename(original_path, new_path):
-        await query.edit_message_text("🚫 File operation failed. Please retry.")
-        return SELECTING_ACTION
+        # Atomic rename
+        if not await atomic_rename(original_path, new_path):
+            await tg_call(edit, "🚫 File operation failed. Please retry.")
+            return SELECTING_ACTION
+        document = new_path
 
     # Guaranteed send
     try:
         await send_file_with_retry(
             update.effective_chat.id,
-            new_path,
+            document,
             final_name,
             context
         )
-        await query.delete_message()
+        await tg_call(query.delete_message)
     except Exception as e:
-        logger.error(f"Final send failed for {user_id}: {e}")
-        await query.edit_message_text("⚠️ Sending failed but file was renamed. Contact support.")
+        logger.error("Final send failed for %s: %s", user_id, e, exc_info=True)
+        await tg_call(edit, "⚠️ Sending failed but file was renamed. Contact support.")
     finally:
         await safe_cleanup(new_path, user_id, context)
 
@@ -242,35 +748,36 @@ async def apply_changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle timeout with state preservation."""
     user_id = update.effective_user.id if update.effective_user else None
-    pdf_data = get_pdf_data(context)
-    
-    if pdf_data and user_id:
-        logger.info(f"Timeout: Preserving state for {user_id}")
-
-    await safe_cleanup(pdf_data.get('file_path') if pdf_data else None, user_id, context)
-    
-    if update.effective_chat:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="⏳ Session expired. Use /start to begin again."
-        )
-    
+    if context.user_data.pop('session_ended', None):
+        # The user was already told why the session ended
+        if user_id is not None and not context.user_data:
+            context.application.drop_user_data(user_id)
+        return FALLBACK
+    # The notice goes out while the session is torn down
+    edit_or_send_later(update, context, TIMEOUT_TEXT)
+
+    if context.user_data.get('need_cleanup'):
+        pdf_state = get_pdf_state(context)
+        if pdf_state and user_id:
+            logger.info("Timeout: Preserving state for %s", user_id)
+        await safe_cleanup(pdf_state.file_path if pdf_state else None, user_id, context)
+
     return FALLBACK
 
 # --- Command and Utility Functions ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command."""
     if update.message:
-        await update.message.reply_text("Welcome! Upload a PDF to rename it.")
+        await tg_send(update.message.reply_text, "Welcome! Upload a PDF to rename it.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /help command."""
     if update.message:
-        await update.message.reply_text("Upload a PDF, then choose options to rename it. Use /start to begin.")
+        await tg_send(update.message.reply_text, "Upload a PDF, then choose options to rename it. Use /start to begin.")
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle errors."""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
     if not update or not update.effective_chat:
         return
     error_message = "⚠️ An error occurred. Please try again or contact support."
@@ -278,7 +785,9 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         error_message = "⚠️ Network issue. Please check your connection and try again."
     elif isinstance(context.error, TelegramError):
         error_message = f"⚠️ Telegram error: {context.error}. Please try again."
-    await context.bot.send_message(
+    notify_later(
+        context.application,
+        context.bot.send_message,
         chat_id=update.effective_chat.id,
         text=error_message
     )
@@ -286,74 +795,103 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def unexpected_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle unexpected messages."""
     if update.message:
-        await update.message.reply_text("⚠️ Unexpected input. Use /cancel to reset.")
+        await tg_send(update.message.reply_text, "⚠️ Unexpected input. Use /cancel to reset.")
     return FALLBACK
 
 async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the current operation."""
     user_id = update.effective_user.id if update.effective_user else None
-    pdf_data = get_pdf_data(context)
-    await safe_cleanup(pdf_data.get('file_path') if pdf_data else None, user_id, context)
+    # Nothing was uploaded this conversation, so there is no session or file to drop
+    if context.user_data.get('need_cleanup'):
+        pdf_state = get_pdf_state(context)
+        await safe_cleanup(pdf_state.file_path if pdf_state else None, user_id, context)
     if update.message:
-        await update.message.reply_text("Operation cancelled. Use /start to begin again.")
+        await tg_send(update.message.reply_text, "Operation cancelled. Use /start to begin again.")
     elif update.callback_query:
-        await update.callback_query.edit_message_text("Operation cancelled. Use /start to begin again.")
+        await tg_call(update.callback_query.edit_message_text, "Operation cancelled. Use /start to begin again.")
     return FALLBACK
 
-async def update_status_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Update the status message with action buttons."""
-    pdf_data = get_pdf_data(context)
-    if not pdf_data:
+async def update_status_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                message: Optional[Message] = None) -> None:
+    """Update the status message with action buttons; edits message when given."""
+    pdf_state = get_pdf_state(context)
+    if not pdf_state:
         if update.message:
-            await update.message.reply_text("❌ Session expired. Upload a PDF again.")
+            await tg_send(update.message.reply_text, "❌ Session expired. Upload a PDF again.")
         return
-    preview = generate_preview_filename(pdf_data)
-    keyboard = [
-        [InlineKeyboardButton("Add Prefix", callback_data="add_prefix"),
-         InlineKeyboardButton("Add Suffix", callback_data="add_suffix")],
-        [InlineKeyboardButton("Remove Text", callback_data="remove_name"),
-         InlineKeyboardButton("Replace Text", callback_data="replace_word")],
-        [InlineKeyboardButton("Change Case", callback_data="change_case"),
-         InlineKeyboardButton("Add Timestamp", callback_data="add_timestamp")],
-        [InlineKeyboardButton("Apply", callback_data="apply"),
-         InlineKeyboardButton("Reset", callback_data="reset"),
-         InlineKeyboardButton("Cancel", callback_data="cancel")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.message:
-        await update.message.reply_text(
-            f"Current filename: `{preview}`\nChoose an action:",
-            reply_markup=reply_markup,
+    preview = generate_preview_filename(pdf_state)
+    text = f"Current filename: `{escape_code(preview)}`\nChoose an action:"
+    if message:
+        await tg_call(
+            message.edit_text,
+            text,
+            reply_markup=MAIN_MENU_MARKUP,
             parse_mode=ParseMode.MARKDOWN_V2
         )
-    elif update.callback_query:
-        await update.callback_query.edit_message_text(
-            f"Current filename: `{preview}`\nChoose an action:",
-            reply_markup=reply_markup,
+        context.user_data['status_render_hash'] = hash(text)
+    elif update.message:
+        await tg_send(
+            update.message.reply_text,
+            text,
+            reply_markup=MAIN_MENU_MARKUP,
             parse_mode=ParseMode.MARKDOWN_V2
         )
+        context.user_data['status_render_hash'] = hash(text)
+    elif update.callback_query:
+        # The keyboard never changes, so the text alone identifies what is shown
+        render_hash = hash(text)
+        if render_hash == context.user_data.get('status_render_hash'):
+            return
+        # Debounce: a newer status edit for this user replaces this one
+        invalidate_status_message(context)
+        context.user_data['status_edit_task'] = context.application.create_task(
+            edit_status_later(context, update.callback_query, text, MAIN_MENU_MARKUP),
+            update=update
+        )
 
-def get_pdf_data(context: ContextTypes.DEFAULT_TYPE) -> dict:
-    """Retrieve pdf_data from context."""
-    return context.user_data.get('pdf_data', {})
+async def edit_status_later(
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    text: str,
+    reply_markup: InlineKeyboardMarkup
+) -> None:
+    """Edit the status message once STATUS_EDIT_DELAY passes without a newer edit."""
+    await asyncio.sleep(STATUS_EDIT_DELAY)
+    await tg_call(
+        query.edit_message_text,
+        text,
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.MARKDOWN_V2
+    )
+    # Only remember what is on screen once the edit actually landed
+    context.user_data['status_render_hash'] = hash(text)
+
+def invalidate_status_message(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Cancel any pending status edit; the message is about to change."""
+    context.user_data.pop('status_render_hash', None)
+    task = context.user_data.pop('status_edit_task', None)
+    if task:
+        task.cancel()
 
-def generate_preview_filename(pdf_data: dict) -> str:
+def get_pdf_state(context: ContextTypes.DEFAULT_TYPE) -> Optional[PdfState]:
+    """Retrieve the user's PdfState from context."""
+    return context.user_data.get('pdf_state')
+
+def generate_preview_filename(pdf_state: Optional[PdfState]) -> str:
     """Generate a preview of the renamed filename."""
-    if not pdf_data or 'original_name' not in pdf_data:
+    if not pdf_state:
         return "Error: No PDF data"
-    name = pdf_data['original_name']
-    prefix = pdf_data.get('prefix', '')
-    suffix = pdf_data.get('suffix', '')
-    remove = pdf_data.get('remove', '')
-    replace = pdf_data.get('replace', {'old': '', 'new': ''})
-    case = pdf_data.get('case')
-    timestamp = pdf_data.get('timestamp', '')
+    name = pdf_state.original_name
+    prefix, suffix, timestamp = pdf_state.prefix, pdf_state.suffix, pdf_state.timestamp
+    remove = pdf_state.remove
+    replace_old, replace_new = pdf_state.replace_old, pdf_state.replace_new
+    case = pdf_state.case
 
     # Apply transformations
     if remove:
         name = name.replace(remove, '')
-    if replace['old'] and replace['new']:
-        name = name.replace(replace['old'], replace['new'])
+    if replace_old:
+        name = name.replace(replace_old, replace_new)
     if case == 'upper':
         name = name.upper()
     elif case == 'lower':
@@ -363,57 +901,48 @@ def generate_preview_filename(pdf_data: dict) -> str:
     name = f"{prefix}{name}{suffix}{timestamp}"
     return sanitize_filename(name)
 
-async def select_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def select_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     """Handle action selection from the inline keyboard."""
     query = update.callback_query
     if not query:
         return FALLBACK
+    if is_duplicate_callback(query):
+        await query.answer()
+        return None  # Stay in the current state
     await query.answer()
+    ended = context.user_data.pop('session_ended', None)
+    if ended:
+        await tg_call(query.edit_message_text, ended)
+        return FALLBACK
     action = query.data
+    if action != "reset":  # Every other action replaces the status message
+        invalidate_status_message(context)
+    edit = query.edit_message_text
 
     if action == "add_prefix":
-        await query.edit_message_text("Enter the prefix to add:")
+        await tg_call(edit, "Enter the prefix to add:")
         return AWAITING_PREFIX
     elif action == "add_suffix":
-        await query.edit_message_text("Enter the suffix to add:")
+        await tg_call(edit, "Enter the suffix to add:")
         return AWAITING_SUFFIX
     elif action == "remove_name":
-        await query.edit_message_text("Enter the text to remove:")
+        await tg_call(edit, "Enter the text to remove:")
         return AWAITING_REMOVE
     elif action == "replace_word":
-        await query.edit_message_text("Enter the text to replace:")
+        await tg_call(edit, "Enter the text to replace:")
         return AWAITING_REPLACE_OLD
     elif action == "change_case":
-        keyboard = [
-            [InlineKeyboardButton("Uppercase", callback_data="case_upper"),
-             InlineKeyboardButton("Lowercase", callback_data="case_lower"),
-             InlineKeyboardButton("Title Case", callback_data="case_title")],
-            [InlineKeyboardButton("Back", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Select case option:", reply_markup=reply_markup)
+        await tg_call(edit, "Select case option:", reply_markup=CASE_MENU_MARKUP)
         return AWAITING_CASE
     elif action == "add_timestamp":
-        keyboard = [
-            [InlineKeyboardButton("YYYYMMDD_HHMMSS", callback_data="ts_ymdhms"),
-             InlineKeyboardButton("YYYYMMDD", callback_data="ts_ymd"),
-             InlineKeyboardButton("DDMMYYYY", callback_data="ts_dmy")],
-            [InlineKeyboardButton("Back", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Select timestamp format:", reply_markup=reply_markup)
+        await tg_call(edit, "Select timestamp format:", reply_markup=TIMESTAMP_MENU_MARKUP)
         return AWAITING_TIMESTAMP
     elif action == "apply":
         return await apply_changes(update, context)
     elif action == "reset":
-        pdf_data = get_pdf_data(context)
-        if pdf_data:
-            pdf_data.update({
-                'prefix': '', 'suffix': '', 'remove': '',
-                'replace': {'old': '', 'new': ''}, 'case': None,
-                'timestamp_format': None, 'timestamp': ''
-            })
-            context.user_data['pdf_data'] = pdf_data
+        pdf_state = get_pdf_state(context)
+        if pdf_state:
+            pdf_state.reset()
         await update_status_message(update, context)
         return SELECTING_ACTION
     elif action == "cancel":
@@ -425,13 +954,13 @@ async def receive_prefix(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not update.message or not update.message.text:
         return AWAITING_PREFIX
     text = update.message.text
+    reply = update.message.reply_text
     if not validate_input(text):
-        await update.message.reply_text("⚠️ Invalid prefix. Try again.")
+        await tg_send(reply, "⚠️ Invalid prefix. Try again.")
         return AWAITING_PREFIX
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['prefix'] = text
-        context.user_data['pdf_data'] = pdf_data
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.prefix = text
     await update_status_message(update, context)
     return SELECTING_ACTION
 
@@ -440,13 +969,13 @@ async def receive_suffix(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not update.message or not update.message.text:
         return AWAITING_SUFFIX
     text = update.message.text
+    reply = update.message.reply_text
     if not validate_input(text):
-        await update.message.reply_text("⚠️ Invalid suffix. Try again.")
+        await tg_send(reply, "⚠️ Invalid suffix. Try again.")
         return AWAITING_SUFFIX
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['suffix'] = text
-        context.user_data['pdf_data'] = pdf_data
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.suffix = text
     await update_status_message(update, context)
     return SELECTING_ACTION
 
@@ -455,13 +984,13 @@ async def receive_remove_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not update.message or not update.message.text:
         return AWAITING_REMOVE
     text = update.message.text
+    reply = update.message.reply_text
     if not validate_input(text):
-        await update.message.reply_text("⚠️ Invalid text. Try again.")
+        await tg_send(reply, "⚠️ Invalid text. Try again.")
         return AWAITING_REMOVE
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['remove'] = text
-        context.user_data['pdf_data'] = pdf_data
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.remove = text
     await update_status_message(update, context)
     return SELECTING_ACTION
 
@@ -470,14 +999,14 @@ async def receive_replace_old(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not update.message or not update.message.text:
         return AWAITING_REPLACE_OLD
     text = update.message.text
+    reply = update.message.reply_text
     if not validate_input(text):
-        await update.message.reply_text("⚠️ Invalid text. Try again.")
+        await tg_send(reply, "⚠️ Invalid text. Try again.")
         return AWAITING_REPLACE_OLD
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['replace']['old'] = text
-        context.user_data['pdf_data'] = pdf_data
-        await update.message.reply_text("Enter the new text to replace with:")
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.replace_old = text
+        await tg_send(reply, "Enter the new text to replace with, or /empty to delete it:")
     return AWAITING_REPLACE_NEW
 
 async def receive_replace_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -485,99 +1014,174 @@ async def receive_replace_new(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not update.message or not update.message.text:
         return AWAITING_REPLACE_NEW
     text = update.message.text
-    if not validate_input(text):
-        await update.message.reply_text("⚠️ Invalid text. Try again.")
+    reply = update.message.reply_text
+    # This state accepts all text, so the commands it understands are picked out here
+    command = text.split(maxsplit=1)[0].split('@', 1)[0] if text.startswith('/') else None
+    if command == '/cancel':
+        return await cancel_operation(update, context)
+    if command == '/empty':
+        text = ''
+    elif not validate_input(text):
+        await tg_send(reply, "⚠️ Invalid text. Try again.")
         return AWAITING_REPLACE_NEW
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['replace']['new'] = text
-        context.user_data['pdf_data'] = pdf_data
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.replace_new = text
     await update_status_message(update, context)
     return SELECTING_ACTION
 
-async def receive_case_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def receive_case_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     """Handle case change selection."""
     query = update.callback_query
     if not query:
         return SELECTING_ACTION
+    if is_duplicate_callback(query):
+        await query.answer()
+        return None  # Stay in the current state
     await query.answer()
     choice = query.data
     if choice == "back_to_menu":
         await update_status_message(update, context)
         return SELECTING_ACTION
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['case'] = choice.split("_")[1]  # e.g., "case_upper" -> "upper"
-        context.user_data['pdf_data'] = pdf_data
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.case = choice.split("_")[1]  # e.g., "case_upper" -> "upper"
     await update_status_message(update, context)
     return SELECTING_ACTION
 
-async def receive_timestamp_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def receive_timestamp_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     """Handle timestamp format selection."""
     query = update.callback_query
     if not query:
         return SELECTING_ACTION
+    if is_duplicate_callback(query):
+        await query.answer()
+        return None  # Stay in the current state
     await query.answer()
     choice = query.data
     if choice == "back_to_menu":
         await update_status_message(update, context)
         return SELECTING_ACTION
     format_choice = choice.split("_")[1]  # e.g., "ts_ymdhms" -> "ymdhms"
-    timestamp = ""
-    if format_choice == "ymdhms":
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    elif format_choice == "ymd":
-        timestamp = datetime.now().strftime("%Y%m%d")
-    elif format_choice == "dmy":
-        timestamp = datetime.now().strftime("%d%m%Y")
-    pdf_data = get_pdf_data(context)
-    if pdf_data:
-        pdf_data['timestamp_format'] = format_choice
-        pdf_data['timestamp'] = f"_{timestamp}" if timestamp else ""
-        context.user_data['pdf_data'] = pdf_data
+    fmt = TIMESTAMP_FORMATS.get(format_choice)
+    timestamp = format_timestamp(fmt, int(time.time())) if fmt else ""
+    pdf_state = get_pdf_state(context)
+    if pdf_state:
+        pdf_state.timestamp_format = format_choice
+        pdf_state.timestamp = f"_{timestamp}" if timestamp else ""
     await update_status_message(update, context)
     return SELECTING_ACTION
 
 # --- Main Bot Setup ---
+async def post_init(application: Application) -> None:
+    """Start long-lived background tasks once the event loop is running."""
+    application.bot_data['cleanup_task'] = asyncio.create_task(cleanup_worker())
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background tasks and unlink anything still queued."""
+    task = application.bot_data.pop('cleanup_task', None)
+    if task:
+        task.cancel()
+    pending = []
+    while not CLEANUP_QUEUE.empty():
+        pending.append(CLEANUP_QUEUE.get_nowait())
+    if pending:
+        await asyncio.get_running_loop().run_in_executor(CLEANUP_EXECUTOR, unlink_batch, pending)
+    # shutdown(wait=True) blocks until the threads exit, so wait for it off the loop
+    await asyncio.to_thread(CLEANUP_EXECUTOR.shutdown, True)
+
 def main() -> None:
     """Initialize with enhanced handlers."""
-    application = Application.builder().token(BOT_TOKEN).build()
+    global DOWNLOADS_DIR_FD  # pylint: disable=global-statement
+    if uvloop:
+        uvloop.install()
+    DOWNLOADS_DIR_FD = open_downloads_dir()
+    if DOWNLOADS_DIR_FD is not None:
+        atexit.register(os.close, DOWNLOADS_DIR_FD)
+    api_request, get_updates_request = build_requests()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(api_request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(AIORateLimiter(overall_max_rate=29, overall_time_period=1))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
+    text_input = filters.TEXT & ~filters.COMMAND
     conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Document.PDF, handle_pdf)],
+        entry_points=[MessageHandler(filters.Document.PDF, serialize_per_session(handle_pdf))],
         states={
             SELECTING_ACTION: [
-                CallbackQueryHandler(select_action, pattern='^(add_prefix|add_suffix|remove_name|replace_word|change_case|add_timestamp|apply|reset|cancel)$')
+                CallbackQueryHandler(
+                    serialize_per_session(select_action),
+                    pattern=MAIN_MENU_ACTIONS.__contains__
+                )
+            ],
+            AWAITING_PREFIX: [MessageHandler(text_input, serialize_per_session(receive_prefix))],
+            AWAITING_SUFFIX: [MessageHandler(text_input, serialize_per_session(receive_suffix))],
+            AWAITING_REMOVE: [
+                MessageHandler(text_input, serialize_per_session(receive_remove_text))
+            ],
+            AWAITING_REPLACE_OLD: [
+                MessageHandler(text_input, serialize_per_session(receive_replace_old))
+            ],
+            AWAITING_REPLACE_NEW: [
+                MessageHandler(filters.TEXT, serialize_per_session(receive_replace_new))
             ],
-            AWAITING_PREFIX: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_prefix)],
-            AWAITING_SUFFIX: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_suffix)],
-            AWAITING_REMOVE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_remove_text)],
-            AWAITING_REPLACE_OLD: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_replace_old)],
-            AWAITING_REPLACE_NEW: [MessageHandler(filters.TEXT | filters.COMMAND, receive_replace_new)],
+            # One handler per state, so an update is checked against a single pattern
             AWAITING_CASE: [
-                CallbackQueryHandler(receive_case_choice, pattern='^case_(upper|lower|title)$'),
-                CallbackQueryHandler(select_action, pattern='^back_to_menu$')
+                CallbackQueryHandler(
+                    serialize_per_session(receive_case_choice),
+                    pattern=CASE_MENU_CALLBACKS.__contains__
+                )
             ],
             AWAITING_TIMESTAMP: [
-                CallbackQueryHandler(receive_timestamp_choice, pattern='^ts_(ymdhms|ymd|dmy)$'),
-                CallbackQueryHandler(select_action, pattern='^back_to_menu$')
+                CallbackQueryHandler(
+                    serialize_per_session(receive_timestamp_choice),
+                    pattern=TIMESTAMP_MENU_CALLBACKS.__contains__
+                )
+            ],
+            ConversationHandler.TIMEOUT: [
+                TypeHandler(Update, serialize_per_session(conversation_timeout))
             ],
         },
         fallbacks=[
-            CommandHandler('cancel', cancel_operation),
-            CallbackQueryHandler(cancel_operation, pattern='^cancel$'),
-            MessageHandler(filters.ALL, unexpected_message)
+            CommandHandler('cancel', serialize_per_session(cancel_operation)),
+            CallbackQueryHandler(serialize_per_session(cancel_operation), pattern='^cancel$'),
+            # Only message kinds a user could plausibly send by mistake get a reply
+            MessageHandler(
+                filters.TEXT | filters.PHOTO | (filters.Document.ALL & ~filters.Document.PDF),
+                unexpected_message
+            )
         ],
         conversation_timeout=600,  # 10 minutes
+        allow_reentry=True,  # A new PDF restarts the conversation
     )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(conv_handler)
     application.add_error_handler(error_handler)
+    application.job_queue.run_repeating(
+        reap_stale_downloads, interval=REAP_INTERVAL, first=REAP_INTERVAL
+    )
 
     logger.info("Bot starting with enhanced reliability")
-    application.run_polling(allowed_updates=Update.all_types())
+    if WEBHOOK_ENDPOINT:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_ENDPOINT,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# bot.py reads its configuration at import time
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("DOWNLOADS_DIR", tempfile.mkdtemp(prefix="pdf-rename-bot-tests-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,215 @@
+import asyncio
+from collections import defaultdict
+from types import MappingProxyType, SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def clean_globals(monkeypatch):
+    monkeypatch.setattr(bot, "ACTIVE_UPLOADS", bot.OrderedDict())
+    monkeypatch.setattr(bot, "CLEANUP_QUEUE", asyncio.Queue())
+
+
+# --- is_transient_error ---
+@pytest.mark.parametrize("error", [RetryAfter(3), NetworkError("reset"), TimedOut()])
+def test_transient_errors_are_retried(error):
+    assert bot.is_transient_error(error)
+
+
+@pytest.mark.parametrize("error", [BadRequest("Message is not modified"), ValueError("boom")])
+def test_permanent_errors_are_not_retried(error):
+    assert not bot.is_transient_error(error)
+
+
+def test_timed_out_send_is_not_retried():
+    assert not bot.is_transient_send_error(TimedOut())
+    assert bot.is_transient_send_error(RetryAfter(1))
+    assert not bot.is_transient_send_error(BadRequest("Chat not found"))
+
+
+# --- generate_preview_filename ---
+def make_state(**options):
+    return bot.PdfState(original_name=options.pop("original_name", "report"), file_id="file-id", **options)
+
+
+def test_preview_without_state():
+    assert bot.generate_preview_filename(None) == "Error: No PDF data"
+
+
+def test_preview_applies_prefix_suffix_case_and_timestamp():
+    state = make_state(prefix="new_", suffix="_v2", case="upper", timestamp="_20240101")
+    assert bot.generate_preview_filename(state) == "new_REPORT_v2_20240101"
+
+
+def test_preview_removes_before_replacing():
+    state = make_state(original_name="abc", remove="b", replace_old="abc", replace_new="X")
+    # "abc" no longer exists once "b" is removed, so nothing is replaced
+    assert bot.generate_preview_filename(state) == "ac"
+
+
+def test_preview_replaces_with_empty_text():
+    state = make_state(original_name="draft report", replace_old="draft ", replace_new="")
+    assert bot.generate_preview_filename(state) == "report"
+
+
+def test_preview_sanitizes_invalid_characters():
+    state = make_state(original_name="a/b:c")
+    assert bot.generate_preview_filename(state) == "abc"
+
+
+def test_reset_keeps_file():
+    state = make_state(prefix="p", suffix="s", remove="r", case="lower", timestamp="_1")
+    state.reset()
+    assert bot.generate_preview_filename(state) == "report"
+    assert state.file_id == "file-id"
+
+
+# --- evict_idle_uploads ---
+def make_application():
+    return SimpleNamespace(user_data=MappingProxyType(defaultdict(dict)))
+
+
+def open_upload(application, user_id, **user_data):
+    application.user_data[user_id].update(user_data)
+    bot.ACTIVE_UPLOADS[user_id] = None
+
+
+def test_evicts_least_recently_active_upload(monkeypatch):
+    monkeypatch.setattr(bot, "MAX_SESSIONS", 1)
+    application = make_application()
+    open_upload(application, 1, pdf_state=make_state(file_path="/tmp/one.pdf"), need_cleanup=True, lang="en")
+    open_upload(application, 2, pdf_state=make_state())
+
+    asyncio.run(bot.evict_idle_uploads(application))
+
+    assert list(bot.ACTIVE_UPLOADS) == [2]
+    evicted = application.user_data[1]
+    assert evicted == {"lang": "en", "session_ended": bot.EVICTED_TEXT}
+    assert bot.CLEANUP_QUEUE.get_nowait() == ("/tmp/one.pdf", 1)
+    assert "pdf_state" in application.user_data[2]
+
+
+def test_mark_upload_active_delays_eviction(monkeypatch):
+    monkeypatch.setattr(bot, "MAX_SESSIONS", 1)
+    application = make_application()
+    open_upload(application, 1, pdf_state=make_state())
+    open_upload(application, 2, pdf_state=make_state())
+    bot.mark_upload_active(1)
+
+    asyncio.run(bot.evict_idle_uploads(application))
+
+    assert list(bot.ACTIVE_UPLOADS) == [1]
+    assert "session_ended" in application.user_data[2]
+
+
+def test_eviction_skips_session_in_use(monkeypatch):
+    monkeypatch.setattr(bot, "MAX_SESSIONS", 1)
+    application = make_application()
+    open_upload(application, 1, pdf_state=make_state())
+    open_upload(application, 2, pdf_state=make_state())
+
+    async def evict_while_locked():
+        async with bot.session_lock(1):
+            await bot.evict_idle_uploads(application)
+
+    asyncio.run(evict_while_locked())
+
+    assert list(bot.ACTIVE_UPLOADS) == [1, 2]
+    assert "pdf_state" in application.user_data[1]
+    assert "session_ended" not in application.user_data[1]
+
+
+def test_eviction_releases_memory_budget(monkeypatch):
+    monkeypatch.setattr(bot, "MAX_SESSIONS", 0)
+    budget = bot.MemoryBudget(1024)
+    monkeypatch.setattr(bot, "PDF_MEMORY", budget)
+    assert budget.reserve(10)
+    application = make_application()
+    open_upload(application, 1, pdf_state=make_state(), pdf_bytes=b"0123456789")
+
+    asyncio.run(bot.evict_idle_uploads(application))
+
+    assert "pdf_bytes" not in application.user_data[1]
+    assert budget.reserve(1024)
+
+
+# --- receive_replace_new ---
+def make_replace_update(text):
+    replies = []
+
+    async def reply_text(message, **kwargs):
+        replies.append(message)
+
+    message = SimpleNamespace(text=text, reply_text=reply_text)
+    return SimpleNamespace(message=message, callback_query=None, effective_user=None), replies
+
+
+@pytest.fixture
+def replace_context(monkeypatch):
+    calls = []
+
+    async def update_status_message(update, context, message=None):
+        calls.append("status")
+
+    async def cancel_operation(update, context):
+        calls.append("cancel")
+        return bot.FALLBACK
+
+    monkeypatch.setattr(bot, "update_status_message", update_status_message)
+    monkeypatch.setattr(bot, "cancel_operation", cancel_operation)
+    context = SimpleNamespace(user_data={"pdf_state": make_state(replace_old="old", replace_new="keep")})
+    return context, calls
+
+
+@pytest.mark.parametrize("text", ["/empty", "/empty@PdfRenameBot", "/empty trailing words"])
+def test_replace_new_empty_command(replace_context, text):
+    context, calls = replace_context
+    update, _ = make_replace_update(text)
+
+    assert asyncio.run(bot.receive_replace_new(update, context)) == bot.SELECTING_ACTION
+    assert context.user_data["pdf_state"].replace_new == ""
+    assert calls == ["status"]
+
+
+@pytest.mark.parametrize("text", ["/cancel", "/cancel@PdfRenameBot"])
+def test_replace_new_cancel_command(replace_context, text):
+    context, calls = replace_context
+    update, _ = make_replace_update(text)
+
+    assert asyncio.run(bot.receive_replace_new(update, context)) == bot.FALLBACK
+    assert context.user_data["pdf_state"].replace_new == "keep"
+    assert calls == ["cancel"]
+
+
+def test_replace_new_plain_text(replace_context):
+    context, calls = replace_context
+    update, _ = make_replace_update("new")
+
+    assert asyncio.run(bot.receive_replace_new(update, context)) == bot.SELECTING_ACTION
+    assert context.user_data["pdf_state"].replace_new == "new"
+    assert calls == ["status"]
+
+
+def test_replace_new_command_prefix_is_not_a_command(replace_context):
+    context, calls = replace_context
+    update, replies = make_replace_update("/emptyish")
+
+    # Not /empty, so it is validated as text and "/" is rejected
+    assert asyncio.run(bot.receive_replace_new(update, context)) == bot.AWAITING_REPLACE_NEW
+    assert context.user_data["pdf_state"].replace_new == "keep"
+    assert replies == ["⚠️ Invalid text. Try again."]
+    assert calls == []
+
+
+def test_replace_new_rejects_invalid_text(replace_context):
+    context, calls = replace_context
+    update, replies = make_replace_update("x" * 101)
+
+    assert asyncio.run(bot.receive_replace_new(update, context)) == bot.AWAITING_REPLACE_NEW
+    assert context.user_data["pdf_state"].replace_new == "keep"
+    assert replies == ["⚠️ Invalid text. Try again."]
+    assert calls == []